@@ -172,9 +172,11 @@ class CoverageManager(object):
         self.log.info('Installing coverage gem on appliance')
         self.ipapp.ssh_client.put_file(gemfile.strpath, bundler_d.strpath)
 
-        # gem install for more recent downstream builds
+        # gem install for more recent downstream builds; skip the download and
+        # install when the gem is already in place from a previous run
         def _gem_install():
             self.ipapp.ssh_client.run_command(
+                'test -d /opt/rh/cfme-gemset/gems/simplecov-0.9.2 || '
                 'gem install --install-dir /opt/rh/cfme-gemset/ -v0.9.2 simplecov')
 
         # bundle install for old downstream and upstream builds
@@ -1,11 +1,12 @@
 #!/usr/bin/env python2
 # -*- coding: utf-8 -*-
 import argparse
-import jenkins
 import re
 import requests
-import subprocess
+import tarfile
 
+from concurrent import futures
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from urlparse import urlsplit, urlunsplit
 
@@ -14,32 +15,70 @@ from cfme.utils.path import log_path
 from cfme.utils.quote import quote
 from cfme.utils.version import Version
 
+# One session for all the Jenkins traffic so the TCP/TLS connection is set up
+# once and then kept alive instead of being re-established for every request.
+session = requests.Session()
+for scheme in ('http://', 'https://'):
+    session.mount(scheme, HTTPAdapter(pool_connections=4, pool_maxsize=32))
 
-def group_list_dict_by(ld, by):
-    result = {}
-    for d in ld:
-        result[d[by]] = d
-    return result
+COVERAGE_RE = re.compile(r'LOC\s+\((\d+\.\d+%)\)\s+covered\.')
 
 
-def jenkins_artifact_url(jenkins_username, jenkins_token, jenkins_url, jenkins_job, jenkins_build,
-        artifact_path):
-    url = '{}/job/{}/{}/artifact/{}'.format(jenkins_url, jenkins_job, jenkins_build, artifact_path)
-    scheme, netloc, path, query, fragment = urlsplit(url)
+def jenkins_authed_job_url(jenkins_username, jenkins_token, jenkins_url, jenkins_job):
+    """Return the job's base URL with the credentials embedded in the netloc.
+
+    Artifact URLs for individual builds are simple concatenations onto this
+    prefix, so the URL only has to be split and reassembled once per job
+    instead of once per artifact.
+    """
+    scheme, netloc, path, query, fragment = urlsplit(jenkins_url)
     netloc = '{}:{}@{}'.format(jenkins_username, jenkins_token, netloc)
-    return urlunsplit([scheme, netloc, path, query, fragment])
+    return '{}/job/{}'.format(
+        urlunsplit([scheme, netloc, path, query, fragment]), jenkins_job)
+
 
+def download_artifact(jenkins_url, jenkins_job, jenkins_build, artifact_path, max_bytes=None):
+    """Download an artifact's text, optionally only its first ``max_bytes`` bytes.
 
-def download_artifact(
-        jenkins_username, jenkins_token, jenkins_url, jenkins_job, jenkins_build,
-        artifact_path):
+    Jenkins' artifact servlet honors Range requests, so small probes (like the
+    appliance_version file) do not have to transfer the whole artifact.
+    """
     url = '{}/job/{}/{}/artifact/{}'.format(jenkins_url, jenkins_job, jenkins_build, artifact_path)
-    return requests.get(
-        url, verify=False, auth=HTTPBasicAuth(jenkins_username, jenkins_token)).text
+    headers = {}
+    if max_bytes is not None:
+        headers['Range'] = 'bytes=0-{}'.format(max_bytes - 1)
+    text = session.get(url, headers=headers).text
+    if max_bytes is not None:
+        # In case the server ignored the Range header.
+        text = text[:max_bytes]
+    return text
+
+
+def get_json(jenkins_url, path, tree=None):
+    """Query the Jenkins JSON API, restricting the response to ``tree`` if given.
 
+    The ``tree`` filter makes Jenkins return only the listed fields instead of
+    the full payload for the object, which can easily be megabytes for jobs
+    with a lot of builds.
+    """
+    url = '{}/{}/api/json'.format(jenkins_url, path)
+    params = {'tree': tree} if tree else {}
+    response = session.get(url, params=params)
+    response.raise_for_status()
+    return response.json()
 
-def get_build_numbers(client, job_name):
-    return [build['number'] for build in client.get_job_info(job_name)['builds']]
+
+def get_builds(jenkins_url, job_name):
+    """Return all builds of the job with their artifact listings, newest first.
+
+    ``allBuilds`` with a composite tree filter gives us the build numbers and
+    artifact listings of every build in a single request, instead of one
+    request for the build list plus one more per build.
+    """
+    job_data = get_json(
+        jenkins_url, 'job/{}'.format(job_name),
+        tree='allBuilds[number,artifacts[fileName,relativePath]]')
+    return job_data['allBuilds']
 
 
 def main(appliance, jenkins_url, jenkins_user, jenkins_token, job_name):
@@ -52,58 +91,90 @@ def main(appliance, jenkins_url, jenkins_user, jenkins_token, job_name):
             raise ValueError(
                 '--jenkins-user and --jenkins-token not provided and credentials yaml does not '
                 'contain the jenkins_app entry with user and token')
+    session.auth = HTTPBasicAuth(jenkins_user, jenkins_token)
+    session.verify = False
     appliance_version = str(appliance.version).strip()
     print('Looking for appliance version {} in {}'.format(appliance_version, job_name))
-    client = jenkins.Jenkins(jenkins_url, username=jenkins_user, password=jenkins_token)
-    build_numbers = get_build_numbers(client, job_name)
-    if not build_numbers:
+    builds = get_builds(jenkins_url, job_name)
+    if not builds:
         print('No builds for job {}'.format(job_name))
         return 1
 
-    # Find the builds with appliance version
-    eligible_build_numbers = set()
-    for build_number in build_numbers:
-        try:
-            artifacts = client.get_build_info(job_name, build_number)['artifacts']
-            if not artifacts:
-                raise ValueError()
-        except (KeyError, ValueError):
+    def classify_build(build):
+        """Check one build for the appliance version and the coverage tarball.
+
+        Returns a ``(verdict, build_number, build_appliance_version, coverage_path)``
+        tuple where the verdict is ``'eligible'``, ``'skip'`` or ``'stop'`` (version
+        older than the appliance's, so no older build can match either) and
+        ``coverage_path`` is the relative path of the coverage tarball for eligible
+        builds.
+        """
+        build_number = build['number']
+        artifacts = build.get('artifacts')
+        if not artifacts:
             print('No artifacts for {}/{}'.format(job_name, build_number))
-            continue
+            return 'skip', build_number, None, None
 
-        artifacts = group_list_dict_by(artifacts, 'fileName')
-        if 'appliance_version' not in artifacts:
+        # Only two artifacts matter, so pick just those instead of indexing
+        # the whole listing.
+        needed_artifacts = {'appliance_version': None, 'coverage-results.tgz': None}
+        for artifact in artifacts:
+            if artifact['fileName'] in needed_artifacts:
+                needed_artifacts[artifact['fileName']] = artifact
+
+        if needed_artifacts['appliance_version'] is None:
             print('appliance_version not in artifacts of {}/{}'.format(job_name, build_number))
-            continue
+            return 'skip', build_number, None, None
 
         build_appliance_version = download_artifact(
-            jenkins_user, jenkins_token, jenkins_url, job_name, build_number,
-            artifacts['appliance_version']['relativePath']).strip()
+            jenkins_url, job_name, build_number,
+            needed_artifacts['appliance_version']['relativePath'], max_bytes=256).strip()
 
         if not build_appliance_version:
             print('Appliance version unspecified for build {}'.format(build_number))
-            continue
+            return 'skip', build_number, None, None
 
         if Version(build_appliance_version) < Version(appliance_version):
-            print(
-                'Build {} already has lower version ({})'.format(
-                    build_number, build_appliance_version))
-            print('Ending here')
-            break
+            return 'stop', build_number, build_appliance_version, None
 
-        if 'coverage-results.tgz' not in artifacts:
+        if needed_artifacts['coverage-results.tgz'] is None:
             print('coverage-results.tgz not in artifacts of {}/{}'.format(job_name, build_number))
-            continue
+            return 'skip', build_number, None, None
 
         if build_appliance_version == appliance_version:
-            print('Build {} waas found to contain what is needed'.format(build_number))
-            eligible_build_numbers.add(build_number)
-        else:
-            print(
-                'Skipping build {} because it does not have correct version ({})'.format(
-                    build_number, build_appliance_version))
+            return (
+                'eligible', build_number, build_appliance_version,
+                needed_artifacts['coverage-results.tgz']['relativePath'])
+
+        print(
+            'Skipping build {} because it does not have correct version ({})'.format(
+                build_number, build_appliance_version))
+        return 'skip', build_number, None, None
+
+    # Find the builds with appliance version. The checks are pure I/O against
+    # Jenkins, so run them in a thread pool; builds is newest-first and the
+    # futures are consumed in that order, so the old "break on an older
+    # version" behaviour is kept by stopping at the first 'stop' verdict and
+    # cancelling the probes that have not started yet.
+    # Maps eligible build numbers to the relative path of their coverage tarball.
+    eligible_builds = {}
+    with futures.ThreadPoolExecutor(max_workers=12) as executor:
+        classify_futures = [executor.submit(classify_build, build) for build in builds]
+        for classify_future in classify_futures:
+            verdict, build_number, build_version, coverage_path = classify_future.result()
+            if verdict == 'stop':
+                print(
+                    'Build {} already has lower version ({})'.format(
+                        build_number, build_version))
+                print('Ending here')
+                for remaining in classify_futures:
+                    remaining.cancel()
+                break
+            elif verdict == 'eligible':
+                print('Build {} was found to contain what is needed'.format(build_number))
+                eligible_builds[build_number] = coverage_path
 
-    if not eligible_build_numbers:
+    if not eligible_builds:
         print(
             'Could not find any coverage reports for {} in {}'.format(
                 appliance_version, job_name))
@@ -118,32 +189,38 @@ def main(appliance, jenkins_url, jenkins_user, jenkins_token, job_name):
     # Upload the merger
     print('Installing coverage merger')
     appliance.coverage._upload_coverage_merger()
-    eligible_build_numbers = sorted(eligible_build_numbers)
     with appliance.ssh_client as ssh:
-        if not ssh.run_command('mkdir -p /var/www/miq/vmdb/coverage'):
-            print('Could not create /var/www/miq/vmdb/coverage on the appliance!')
-            return 3
-        # Download all the coverage reports
-        for build_number in eligible_build_numbers:
-            print('Downloading the coverage report from build {}'.format(build_number))
-            download_url = jenkins_artifact_url(
-                jenkins_user, jenkins_token, jenkins_url, job_name, build_number,
-                'log/coverage/coverage-results.tgz')
-            cmd = ssh.run_command(
-                'curl -k -o /var/www/miq/vmdb/coverage/tmp.tgz {}'.format(quote(download_url)))
-            if not cmd:
-                print('Could not download! - {}'.format(str(cmd)))
-                return 4
-            print('Extracting the coverage report from build {}'.format(build_number))
-            extract_command = ' && '.join([
-                'cd /var/www/miq/vmdb/coverage',
-                'tar xf tmp.tgz --strip-components=1',
-                'rm -f tmp.tgz',
-            ])
-            cmd = ssh.run_command(extract_command)
-            if not cmd:
-                print('Could not extract! - {}'.format(str(cmd)))
-                return 5
+        # Download all the coverage reports in one remote script so only a
+        # single SSH exec channel is set up for the whole loop. Each download
+        # streams straight into tar so the network transfer and the extraction
+        # overlap and the tarball never hits the appliance's disk. The builds
+        # are independent, so xargs -P runs several downloads concurrently;
+        # each one extracts into its own temp directory which is then merged
+        # into the coverage directory, to keep concurrent tars from clashing.
+        authed_job_url = jenkins_authed_job_url(
+            jenkins_user, jenkins_token, jenkins_url, job_name)
+        download_urls = [
+            '{}/{}/artifact/{}'.format(
+                authed_job_url, build_number, eligible_builds[build_number])
+            for build_number in sorted(eligible_builds)]
+        # curl -f turns HTTP errors into a non-zero exit code; a build whose
+        # download fails is logged and skipped rather than failing the batch,
+        # since the artifact listing already told us the artifacts exist.
+        download_script = (
+            'mkdir -p /var/www/miq/vmdb/coverage && '
+            "printf '%s\\n' {urls} | xargs -P 6 -n 1 bash -c "
+            "'set -o pipefail; d=$(mktemp -d -p /var/www/miq/vmdb/coverage); "
+            'curl -kfsS "$0" | tar xzf - --strip-components=1 -C "$d" '
+            '&& cp -a "$d"/. /var/www/miq/vmdb/coverage/ '
+            '|| echo "Could not download ${{0#*@}}"; rm -rf "$d"\'').format(
+                urls=' '.join(quote(url) for url in download_urls))
+        print(
+            'Downloading the coverage reports from builds {}'.format(
+                ', '.join(str(build_number) for build_number in sorted(eligible_builds))))
+        cmd = ssh.run_command(download_script, timeout=60 * 60)
+        if not cmd:
+            print('Could not download and extract! - {}'.format(str(cmd)))
+            return 4
 
         # Now run the merger
         print('Running the merger')
@@ -155,8 +232,10 @@ def main(appliance, jenkins_url, jenkins_user, jenkins_token, job_name):
             return 6
         else:
             print('Coverage report generation was successful')
-            print(str(cmd))
-            percentage = re.search(r'LOC\s+\((\d+.\d+%)\)\s+covered\.', str(cmd))
+            print(cmd.output)
+            # The LOC summary is one of the last lines the merger prints, so
+            # only the tail of the potentially huge output needs scanning.
+            percentage = COVERAGE_RE.search(cmd.output[-4096:])
             if percentage:
                 print('COVERAGE={};'.format(percentage.groups()[0]))
             else:
@@ -167,16 +246,21 @@ def main(appliance, jenkins_url, jenkins_user, jenkins_token, job_name):
         if not cmd:
             print('Could not compress! - {}'.format(str(cmd)))
             return 7
-        print('Grabbing the generated HTML')
-        ssh.get_file('/tmp/merged.tgz', log_path.strpath)
-        print('Decompressing the generated HTML')
-        rc = subprocess.call(
-            ['tar', 'xf', log_path.join('merged.tgz').strpath, '-C', log_path.strpath])
-        if rc == 0:
-            print('Done!')
-        else:
-            print('Failure to extract')
+        print('Grabbing and decompressing the generated HTML')
+        # Stream the remote tarball straight into the extractor ('r|gz' is
+        # single-pass streaming mode), so it is never written out locally.
+        try:
+            sftp = ssh.open_sftp()
+            with sftp.open('/tmp/merged.tgz', 'rb') as merged_tgz:
+                # Extract in 1MB blocks instead of tarfile's default 10KB to
+                # keep the read round trips and syscall count down.
+                with tarfile.open(
+                        fileobj=merged_tgz, mode='r|gz', bufsize=1024 * 1024) as tf:
+                    tf.extractall(log_path.strpath)
+        except (IOError, tarfile.TarError) as e:
+            print('Failure to extract - {}'.format(e))
             return 8
+        print('Done!')
 
 
 if __name__ == '__main__':